@@ -26,8 +26,9 @@ Use Swiss ephemeris to calculate tithi, nakshatra, etc.
 """
 
 from __future__ import division
-from math import floor, ceil
+from math import floor, ceil, sin, cos, tan, atan2, asin, acos, radians, degrees
 from collections import namedtuple as struct
+import json
 import swisseph as swe
 
 Date = struct('Date', ['year', 'month', 'day'])
@@ -75,81 +76,204 @@ def inverse_lagrange(x, y, ya):
 gregorian_to_jd = lambda date: swe.julday(date.year, date.month, date.day, 0.0)
 jd_to_gregorian = lambda jd: swe.revjul(jd, swe.GREG_CAL)   # returns (y, m, d, h, min, s)
 
+# ----- EPHEMERIS BACKENDS ------
+# Every astronomical quantity used below is fetched through the module-level
+# 'backend', so it can be replaced by one with the same four methods:
+#   calc(jd, body)           -> [longitude, latitude, speed in longitude/day]
+#   ayanamsa(jd, mode)       -> ayanamsa in degrees for a swe.SIDM_* mode
+#   rise_trans(jd, body, lon, lat, rsmi) -> julian day of next rise/set
+#   sidtime(jd)              -> Greenwich sidereal time in hours
+
+class SwissEphemeris(object):
+  """Default backend, computes everything with the Swiss ephemeris"""
+  def calc(self, jd, body):
+    data = swe.calc_ut(jd, body, flag = swe.FLG_SWIEPH + swe.FLG_SPEED)
+    return [data[0], data[1], data[3]]
+
+  def ayanamsa(self, jd, mode = swe.SIDM_LAHIRI):
+    swe.set_sid_mode(mode)
+    return swe.get_ayanamsa_ut(jd)
+
+  def rise_trans(self, jd, body, lon, lat, rsmi):
+    result = swe.rise_trans(jd, body, lon, lat, rsmi=rsmi)
+    return result[1][0]
+
+  def sidtime(self, jd):
+    return swe.sidtime(jd)
+
+class RecordingBackend(object):
+  """Passes every call on to another backend (Swiss ephemeris by default)
+     and remembers the answers, so that a workload can be saved and replayed.
+     Repeated calls are answered from memory. 'calls' counts all calls."""
+  def __init__(self, backend = None):
+    self.backend = backend or SwissEphemeris()
+    self.records = {}
+    self.calls = 0
+
+  def fetch(self, method, *args):
+    self.calls += 1
+    key = (method,) + args
+    if key not in self.records:
+      self.records[key] = getattr(self.backend, method)(*args)
+    return self.records[key]
+
+  def calc(self, jd, body):
+    return self.fetch('calc', jd, body)
+
+  def ayanamsa(self, jd, mode = swe.SIDM_LAHIRI):
+    return self.fetch('ayanamsa', jd, mode)
+
+  def rise_trans(self, jd, body, lon, lat, rsmi):
+    return self.fetch('rise_trans', jd, body, lon, lat, rsmi)
+
+  def sidtime(self, jd):
+    return self.fetch('sidtime', jd)
+
+  def save(self, filename):
+    """Write all recorded calls to a JSON file (floats are stored exactly)"""
+    records = [ list(key) + [value] for (key, value) in self.records.items() ]
+    with open(filename, 'w') as f:
+      json.dump(records, f, separators = (',', ':'))
+
+class ReplayBackend(RecordingBackend):
+  """Answers calls from a file saved by RecordingBackend, without computing
+     anything. Raises KeyError for any call that was not recorded."""
+  def __init__(self, filename):
+    self.records = {}
+    self.calls = 0
+    with open(filename) as f:
+      for record in json.load(f):
+        self.records[tuple(record[:-1])] = record[-1]
+
+  def fetch(self, method, *args):
+    self.calls += 1
+    key = (method,) + args
+    if key not in self.records:
+      raise KeyError("%s%s was not recorded" % (method, args))
+    return self.records[key]
+
+backend = SwissEphemeris()
+
+def set_backend(new_backend):
+  """Route all further calculations through new_backend. Returns the old one."""
+  global backend
+  old, backend = backend, new_backend
+  return old
+
 def solar_longitude(jd):
   """Solar longitude at given instant (julian day) jd"""
-  data = swe.calc_ut(jd, swe.SUN, flag = swe.FLG_SWIEPH)
+  data = backend.calc(jd, swe.SUN)
   return data[0]   # in degrees
 
 def lunar_longitude(jd):
   """Lunar longitude at given instant (julian day) jd"""
-  data = swe.calc_ut(jd, swe.MOON, flag = swe.FLG_SWIEPH)
+  data = backend.calc(jd, swe.MOON)
   return data[0]   # in degrees
 
 def lunar_latitude(jd):
   """Lunar latitude at given instant (julian day) jd"""
-  data = swe.calc_ut(jd, swe.MOON, flag = swe.FLG_SWIEPH)
+  data = backend.calc(jd, swe.MOON)
   return data[1]   # in degrees
 
 def sunrise(jd, place):
   """Sunrise when centre of disc is at horizon for given date and place"""
   lat, lon, tz = place
-  result = swe.rise_trans(jd - tz/24, swe.SUN, lon, lat, rsmi=swe.BIT_DISC_CENTER + swe.CALC_RISE)
-  rise = result[1][0]  # julian-day number
+  rsmi = swe.BIT_DISC_CENTER + swe.CALC_RISE
+  rise = backend.rise_trans(jd - tz/24, swe.SUN, lon, lat, rsmi)  # julian-day number
   # Convert to local time
   return [rise + tz/24., to_dms((rise - jd) * 24 + tz)]
 
 def sunset(jd, place):
   """Sunset when centre of disc is at horizon for given date and place"""
   lat, lon, tz = place
-  result = swe.rise_trans(jd - tz/24, swe.SUN, lon, lat, rsmi=swe.BIT_DISC_CENTER + swe.CALC_SET)
-  setting = result[1][0]  # julian-day number
+  rsmi = swe.BIT_DISC_CENTER + swe.CALC_SET
+  setting = backend.rise_trans(jd - tz/24, swe.SUN, lon, lat, rsmi)  # julian-day number
   # Convert to local time
   return [setting + tz/24., to_dms((setting - jd) * 24 + tz)]
 
 def moonrise(jd, place):
   """Moonrise when centre of disc is at horizon for given date and place"""
   lat, lon, tz = place
-  result = swe.rise_trans(jd - tz/24, swe.MOON, lon, lat, rsmi=swe.BIT_DISC_CENTER + swe.CALC_RISE)
-  rise = result[1][0]  # julian-day number
+  rsmi = swe.BIT_DISC_CENTER + swe.CALC_RISE
+  rise = backend.rise_trans(jd - tz/24, swe.MOON, lon, lat, rsmi)  # julian-day number
   # Convert to local time
   return to_dms((rise - jd) * 24 + tz)
 
 def moonset(jd, place):
   """Moonset when centre of disc is at horizon for given date and place"""
   lat, lon, tz = place
-  result = swe.rise_trans(jd - tz/24, swe.MOON, lon, lat, rsmi=swe.BIT_DISC_CENTER + swe.CALC_SET)
-  setting = result[1][0]  # julian-day number
+  rsmi = swe.BIT_DISC_CENTER + swe.CALC_SET
+  setting = backend.rise_trans(jd - tz/24, swe.MOON, lon, lat, rsmi)  # julian-day number
   # Convert to local time
   return to_dms((setting - jd) * 24 + tz)
 
+# Precision tiers. End times are interpolated from samples at these offsets
+# (fraction of a day after sunrise) and new moons from this many samples
+# over 4 days. 'exact' samples like 'standard', then refines every end time
+# by Newton's method on the ephemeris itself. See precision_report().
+precision_offsets = {'fast': [1/3, 2/3, 1.0],
+                     'standard': [0.25, 0.5, 0.75, 1.0],
+                     'exact': [0.25, 0.5, 0.75, 1.0]}
+new_moon_points = {'fast': 5, 'standard': 17, 'exact': 17}
+
+def tithi_motion(jd):
+  """Lunar phase at jd and its rate in degrees/day"""
+  moon, sun = backend.calc(jd, swe.MOON), backend.calc(jd, swe.SUN)
+  return [(moon[0] - sun[0]) % 360, moon[2] - sun[2]]
+
+def nakshatra_motion(jd, mode = swe.SIDM_LAHIRI):
+  """Nirayana lunar longitude at jd and its rate in degrees/day"""
+  moon = backend.calc(jd, swe.MOON)
+  return [(moon[0] - backend.ayanamsa(jd, mode)) % 360, moon[2]]
+
+def yoga_motion(jd, mode = swe.SIDM_LAHIRI):
+  """Sum of nirayana solar and lunar longitudes at jd and its rate in degrees/day"""
+  moon, sun = backend.calc(jd, swe.MOON), backend.calc(jd, swe.SUN)
+  return [(moon[0] + sun[0] - 2 * backend.ayanamsa(jd, mode)) % 360, moon[2] + sun[2]]
+
+def refine(motion, jd, target):
+  """Newton's method: improve jd (julian day) so that angle motion(jd)[0] = target"""
+  for i in range(5):
+    angle, rate = motion(jd)
+    step = ((target - angle + 180) % 360 - 180) / rate
+    jd += step
+    # Error left after a step is about (step ** 2) / 10 days
+    if abs(step) < 1e-4: break
+  return jd
+
 # Tithi doesn't depend on Ayanamsa
-def tithi(jd, place):
-  """Tithi at sunrise for given date and place. Also returns tithi's end time."""
+def tithi(jd, place, precision = 'standard'):
+  """Tithi at sunrise for given date and place. Also returns tithi's end time.
+     precision = 'fast', 'standard' or 'exact' (see precision_offsets)"""
   tz = place.timezone
   # 1. Find time of sunrise
   rise = sunrise(jd, place)[0] - tz / 24
 
   # 2. Find tithi at this JDN
-  moon_phase = lunar_phase(rise)
+  lunar_long = lunar_longitude(rise)
+  solar_long = solar_longitude(rise)
+  moon_phase = (lunar_long - solar_long) % 360
   today = ceil(moon_phase / 12)
   degrees_left = today * 12 - moon_phase
 
-  # 3. Compute longitudinal differences at intervals of 0.25 days from sunrise
-  offsets = [0.25, 0.5, 0.75, 1.0]
-  lunar_long_diff = [ (lunar_longitude(rise + t) - lunar_longitude(rise)) % 360 for t in offsets ]
-  solar_long_diff = [ (solar_longitude(rise + t) - solar_longitude(rise)) % 360 for t in offsets ]
+  # 3. Compute longitudinal differences at intervals from sunrise
+  offsets = precision_offsets[precision]
+  lunar_long_diff = [ (lunar_longitude(rise + t) - lunar_long) % 360 for t in offsets ]
+  solar_long_diff = [ (solar_longitude(rise + t) - solar_long) % 360 for t in offsets ]
   relative_motion = [ moon - sun for (moon, sun) in zip(lunar_long_diff, solar_long_diff) ]
 
-  # 4. Find end time by 4-point inverse Lagrange interpolation
+  # 4. Find end time by inverse Lagrange interpolation
   y = relative_motion
   x = offsets
   # compute fraction of day (after sunrise) needed to traverse 'degrees_left'
   approx_end = inverse_lagrange(x, y, degrees_left)
+  if precision == 'exact':
+    approx_end = refine(tithi_motion, rise + approx_end, today * 12) - rise
   ends = (rise + approx_end -jd) * 24 + tz
   answer = [int(today), to_dms(ends)]
 
-  # 5. Check for skipped tithi
-  moon_phase_tmrw = lunar_phase(rise + 1)
+  # 5. Check for skipped tithi (last offset is 1 day after sunrise)
+  moon_phase_tmrw = (moon_phase + relative_motion[-1]) % 360
   tomorrow = ceil(moon_phase_tmrw / 12)
   isSkipped = (tomorrow - today) % 30 > 1
   if isSkipped:
@@ -157,33 +281,38 @@ def tithi(jd, place):
     leap_tithi = today + 1
     degrees_left = leap_tithi * 12 - moon_phase
     approx_end = inverse_lagrange(x, y, degrees_left)
+    if precision == 'exact':
+      approx_end = refine(tithi_motion, rise + approx_end, leap_tithi * 12) - rise
     ends = (rise + approx_end -jd) * 24 + place.timezone
     answer += [int(leap_tithi), to_dms(ends)]
 
   return answer
 
 
-def nakshatra(jd, place):
+def nakshatra(jd, place, precision = 'standard'):
   """Current nakshatra as of julian day (jd)
      1 = Asvini, 2 = Bharani, ..., 27 = Revati
+     precision = 'fast', 'standard' or 'exact' (see precision_offsets)
   """
-  swe.set_sid_mode(swe.SIDM_LAHIRI)
   # 1. Find time of sunrise
   lat, lon, tz = place
   rise = sunrise(jd, place)[0] - tz / 24.  # Sunrise at UT 00:00
 
   # Swiss Ephemeris always gives Sayana. So subtract ayanamsa to get Nirayana
-  offsets = [0.0, 0.25, 0.5, 0.75, 1.0]
-  longitudes = [ (lunar_longitude(rise + t) - swe.get_ayanamsa_ut(rise)) % 360 for t in offsets]
+  offsets = [0.0] + precision_offsets[precision]
+  ayanamsa = backend.ayanamsa(rise)
+  longitudes = [ (lunar_longitude(rise + t) - ayanamsa) % 360 for t in offsets]
 
   # 2. Today's nakshatra is when offset = 0
   # There are 27 Nakshatras spanning 360 degrees
   nak = ceil(longitudes[0] * 27 / 360)
 
-  # 3. Find end time by 5-point inverse Lagrange interpolation
+  # 3. Find end time by inverse Lagrange interpolation
   y = unwrap_angles(longitudes)
   x = offsets
   approx_end = inverse_lagrange(x, y, nak * 360 / 27)
+  if precision == 'exact':
+    approx_end = refine(nakshatra_motion, rise + approx_end, nak * 360 / 27) - rise
   ends = (rise - jd + approx_end) * 24 + tz
   answer = [int(nak), to_dms(ends)]
 
@@ -193,24 +322,29 @@ def nakshatra(jd, place):
   if isSkipped:
     leap_nak = nak + 1
     approx_end = inverse_lagrange(offsets, longitudes, leap_nak * 360 / 27)
+    if precision == 'exact':
+      approx_end = refine(nakshatra_motion, rise + approx_end, leap_nak * 360 / 27) - rise
     ends = (rise - jd + approx_end) * 24 + tz
     answer += [int(leap_nak), to_dms(ends)]
 
   return answer
 
 
-def yoga(jd, place):
+def yoga(jd, place, precision = 'standard'):
   """Yoga at given jd and place.
      1 = Vishkambha, 2 = Priti, ..., 27 = Vaidhrti
+     precision = 'fast', 'standard' or 'exact' (see precision_offsets)
   """
-  swe.set_sid_mode(swe.SIDM_LAHIRI)
   # 1. Find time of sunrise
   lat, lon, tz = place
   rise = sunrise(jd, place)[0] - tz / 24.  # Sunrise at UT 00:00
 
   # 2. Find the Nirayana longitudes and add them
-  lunar_long = (lunar_longitude(rise) - swe.get_ayanamsa_ut(rise)) % 360
-  solar_long = (solar_longitude(rise) - swe.get_ayanamsa_ut(rise)) % 360
+  ayanamsa = backend.ayanamsa(rise)
+  lunar_sayana = lunar_longitude(rise)
+  solar_sayana = solar_longitude(rise)
+  lunar_long = (lunar_sayana - ayanamsa) % 360
+  solar_long = (solar_sayana - ayanamsa) % 360
   total = (lunar_long + solar_long) % 360
   # There are 27 Yogas spanning 360 degrees
   yog = ceil(total * 27 / 360)
@@ -218,24 +352,24 @@ def yoga(jd, place):
   # 3. Find how many longitudes is there left to be swept
   degrees_left = yog * (360 / 27) - total
 
-  # 3. Compute longitudinal sums at intervals of 0.25 days from sunrise
-  offsets = [0.25, 0.5, 0.75, 1.0]
-  lunar_long_diff = [ (lunar_longitude(rise + t) - lunar_longitude(rise)) % 360 for t in offsets ]
-  solar_long_diff = [ (solar_longitude(rise + t) - solar_longitude(rise)) % 360 for t in offsets ]
+  # 3. Compute longitudinal sums at intervals from sunrise
+  offsets = precision_offsets[precision]
+  lunar_long_diff = [ (lunar_longitude(rise + t) - lunar_sayana) % 360 for t in offsets ]
+  solar_long_diff = [ (solar_longitude(rise + t) - solar_sayana) % 360 for t in offsets ]
   total_motion = [ moon + sun for (moon, sun) in zip(lunar_long_diff, solar_long_diff) ]
 
-  # 4. Find end time by 4-point inverse Lagrange interpolation
+  # 4. Find end time by inverse Lagrange interpolation
   y = total_motion
   x = offsets
   # compute fraction of day (after sunrise) needed to traverse 'degrees_left'
   approx_end = inverse_lagrange(x, y, degrees_left)
+  if precision == 'exact':
+    approx_end = refine(yoga_motion, rise + approx_end, yog * 360 / 27) - rise
   ends = (rise + approx_end - jd) * 24 + tz
   answer = [int(yog), to_dms(ends)]
 
-  # 5. Check for skipped yoga
-  lunar_long_tmrw = (lunar_longitude(rise + 1) - swe.get_ayanamsa_ut(rise + 1)) % 360
-  solar_long_tmrw = (solar_longitude(rise + 1) - swe.get_ayanamsa_ut(rise + 1)) % 360
-  total_tmrw = (lunar_long_tmrw + solar_long_tmrw) % 360
+  # 5. Check for skipped yoga (last offset is 1 day after sunrise)
+  total_tmrw = (total + total_motion[-1]) % 360
   tomorrow = ceil(total_tmrw * 27 / 360)
   isSkipped = (tomorrow - yog) % 27 > 1
   if isSkipped:
@@ -243,6 +377,8 @@ def yoga(jd, place):
     leap_yog = yog + 1
     degrees_left = leap_yog * (360 / 27) - total
     approx_end = inverse_lagrange(x, y, degrees_left)
+    if precision == 'exact':
+      approx_end = refine(yoga_motion, rise + approx_end, leap_yog * 360 / 27) - rise
     ends = (rise + approx_end - jd) * 24 + tz
     answer += [int(leap_yog), to_dms(ends)]
 
@@ -267,19 +403,31 @@ def vaara(jd):
   """Weekday for given Julian day. 0 = Sunday, 1 = Monday,..., 6 = Saturday"""
   return int(ceil(jd + 1) % 7)
 
-def masa(jd, place):
+def masa(jd, place, system = 'amanta', precision = 'standard'):
   """Returns lunar month and if it is adhika or not.
-     1 = Chaitra, 2 = Vaisakha, ..., 12 = Phalguna"""
-  ti = tithi(jd, place)[0]
+     1 = Chaitra, 2 = Vaisakha, ..., 12 = Phalguna
+     system = 'amanta' (new moon to new moon) or 'purnimanta' (full moon to full moon)
+     precision is as in tithi()"""
+  ti = tithi(jd, place, precision)[0]
   critical = sunrise(jd, place)[0]  # - tz/24 ?
-  last_new_moon = new_moon(critical, ti, -1)
-  next_new_moon = new_moon(critical, ti, +1)
+  last_new_moon = new_moon(critical, ti, -1, precision)
+  next_new_moon = new_moon(critical, ti, +1, precision)
   this_solar_month = raasi(last_new_moon)
   next_solar_month = raasi(next_new_moon)
   is_leap_month = (this_solar_month == next_solar_month)
   maasa = this_solar_month + 1
   if maasa > 12: maasa = (maasa % 12)
-  return [int(maasa), is_leap_month]
+  answer = [int(maasa), is_leap_month]
+  if system == 'purnimanta': answer = purnimanta(answer, ti)
+  return answer
+
+def purnimanta(maasa, tithi_):
+  """Purnimanta month for the amanta month [number, is_leap] of masa() on a
+     day with given tithi. Krishna paksha belongs to the following month,
+     except in an adhika month, which is always from new moon to new moon."""
+  num, is_leap = maasa
+  if tithi_ > 15 and not is_leap: num = num % 12 + 1
+  return [num, is_leap]
 
 # epoch-midnight to given midnight
 # Days elapsed since beginning of Kali Yuga
@@ -295,25 +443,28 @@ def elapsed_year(jd, maasa_num):
 
 # New moon day: sun and moon have same longitude (0 degrees = 360 degrees difference)
 # Full moon day: sun and moon are 180 deg apart
-def new_moon(jd, tithi_, opt = -1):
+def new_moon(jd, tithi_, opt = -1, precision = 'standard'):
   """Returns JDN, where
      opt = -1:  JDN < jd such that lunar_phase(JDN) = 360 degrees
      opt = +1:  JDN >= jd such that lunar_phase(JDN) = 360 degrees
+     precision = 'fast', 'standard' or 'exact' (see new_moon_points)
   """
   if opt == -1:  start = jd - tithi_         # previous new moon
   if opt == +1:  start = jd + (30 - tithi_)  # next new moon
   # Search within a span of (start +- 2) days
-  x = [ -2 + offset/4 for offset in range(17) ]
+  points = new_moon_points[precision]
+  x = [ -2 + 4 * offset / (points - 1) for offset in range(points) ]
   y = [lunar_phase(start + i) for i in x]
   y = unwrap_angles(y)
   y0 = inverse_lagrange(x, y, 360)
+  if precision == 'exact':
+    return refine(tithi_motion, start + y0, 360)
   return start + y0
 
 def raasi(jd):
   """Zodiac of given jd. 1 = Mesha, ... 12 = Meena"""
-  swe.set_sid_mode(swe.SIDM_LAHIRI)
   s = solar_longitude(jd)
-  solar_nirayana = (solar_longitude(jd) - swe.get_ayanamsa_ut(jd)) % 360
+  solar_nirayana = (solar_longitude(jd) - backend.ayanamsa(jd)) % 360
   # 12 rasis occupy 360 degrees, so each one is 30 degrees
   return ceil(solar_nirayana / 30.)
 
@@ -323,11 +474,13 @@ def lunar_phase(jd):
   moon_phase = (lunar_long - solar_long) % 360
   return moon_phase
 
-def samvatsara(jd, maasa_num):
+def samvatsara(jd, maasa_num, system = 'south'):
+  """1 = Prabhava, ..., 59 = Krodhana, 0 = Akshaya. system = 'south' or 'north'"""
   kali = elapsed_year(jd, maasa_num)[0]
-  # Change 14 to 0 for North Indian tradition
+  # South Indian tradition drops 14 years from kali 4009 onwards, the North
+  # Indian one keeps the full kali year and its expunctions (211/18000 below)
   # See the function "get_Jovian_Year_name_south" in pancanga.pl
-  if kali >= 4009:    kali = (kali - 14) % 60
+  if system != 'north' and kali >= 4009:    kali = (kali - 14) % 60
   samvat = (kali + 27 + int((kali * 211 - 108) / 18000)) % 60
   return samvat
 
@@ -341,6 +494,258 @@ def day_duration(jd, place):
   diff = (sset - srise) * 24     # In hours
   return [diff, to_dms(diff)]
 
+# Navagraha in traditional order: Surya, Chandra, Mangala, Budha, Guru,
+# Sukra, Sani, Rahu, Ketu. Rahu is the mean ascending node of the moon and
+# Ketu is not a Swiss ephemeris body: it is always 180 degrees from Rahu.
+rahu = swe.MEAN_NODE
+ketu = -swe.MEAN_NODE
+planet_list = [swe.SUN, swe.MOON, swe.MARS, swe.MERCURY, swe.JUPITER,
+               swe.VENUS, swe.SATURN, rahu, ketu]
+
+def nirayana_longitudes(jds, bodies = planet_list):
+  """Nirayana longitudes of given bodies at each instant (julian day) in jds.
+     Returns a table with one row per instant and one column per body."""
+  table = []
+  for jd in jds:
+    # Ayanamsa (and the node, for Rahu and Ketu) only once per instant
+    ayanamsa = backend.ayanamsa(jd)
+    sayana = {}
+    for body in bodies:
+      if abs(body) not in sayana:
+        sayana[abs(body)] = backend.calc(jd, abs(body))[0]
+    row = [ (sayana[abs(body)] + (180 if body == ketu else 0) - ayanamsa) % 360
+            for body in bodies ]
+    table.append(row)
+  return table
+
+def navagraha(jd, place):
+  """Nirayana longitudes of the nine grahas (see planet_list) at sunrise
+     for given date and place"""
+  rise = sunrise(jd, place)[0] - place.timezone / 24.
+  return nirayana_longitudes([rise])[0]
+
+# Sampling interval (in days) used to bracket ingresses. It must be small
+# enough that a body never crosses two nakshatras between samples, nor
+# crosses a boundary and comes back while stationary.
+ingress_step = {swe.MOON: 0.25, swe.MERCURY: 0.25, swe.VENUS: 0.5}
+
+def boundary_distance(body, jd, boundary):
+  """Signed angle (degrees) of body's nirayana longitude past boundary at jd,
+     and its rate in degrees/day"""
+  data = backend.calc(jd, abs(body))
+  lon = data[0] + (180 if body == ketu else 0) - backend.ayanamsa(jd)
+  return [(lon - boundary + 180) % 360 - 180, data[2]]
+
+def ingress(body, jd_start, jd_end, divisions = 12):
+  """Ingresses of body into a new rashi (divisions = 12) or nakshatra
+     (divisions = 27) between julian days jd_start and jd_end.
+     Returns a list of [JDN, number] where number is the rashi/nakshatra entered.
+  """
+  step = ingress_step.get(body, 1.0)
+  span = 360 / divisions
+  count = int(ceil((jd_end - jd_start) / step))
+  # 1. Sample on a uniform grid covering the range
+  x = [ jd_start + i * step for i in range(count + 1) ]
+  y = [ row[0] for row in nirayana_longitudes(x, [body]) ]
+  segment = [ ceil(lon / span) for lon in y ]
+
+  result = []
+  for i in range(len(x) - 1):
+    if segment[i] == segment[i+1]: continue
+    # 2. Boundary crossed in [x[i], x[i+1]]; forward or retrograde?
+    forward = (segment[i+1] - segment[i]) % divisions == 1
+    boundary = segment[i] * span if forward else (segment[i] - 1) * span
+    # Angular distance from boundary changes sign over the bracket
+    a, b = x[i], x[i+1]
+    da = (y[i] - boundary + 180) % 360 - 180
+    db = (y[i+1] - boundary + 180) % 360 - 180
+    t = a + (b - a) * da / (da - db)
+
+    # 3. Newton's method on the body's speed, falling back to bisection
+    # whenever a step leaves the bracket (e.g. near a station)
+    for k in range(60):
+      dist, speed = boundary_distance(body, t, boundary)
+      if (dist < 0) == (da < 0): a = t
+      else: b = t
+      t_next = t - dist / speed if speed else a - 1
+      if not a <= t_next <= b: t_next = (a + b) / 2
+      converged = abs(t_next - t) < 1e-6 or b - a < 1e-6   # 0.1 second
+      t = t_next
+      if converged: break
+
+    if jd_start <= t < jd_end:
+      entered = segment[i+1] if forward else segment[i] - 1
+      result.append([t, int((entered - 1) % divisions + 1)])
+
+  return result
+
+# Sidereal time advances by this many degrees per (solar) day
+sidereal_rate = 360.98564736629
+
+def sidereal_state(jd):
+  """Greenwich sidereal time (in degrees), true obliquity of the ecliptic and
+     ayanamsa at given instant jd. For a few days around jd, the sidereal time
+     grows uniformly at sidereal_rate and the other two are practically fixed."""
+  gst = backend.sidtime(jd) * 15
+  obliquity = backend.calc(jd, swe.ECL_NUT)[0]
+  return [jd, gst, obliquity, backend.ayanamsa(jd)]
+
+def ascendant(jd, place, state = None):
+  """Nirayana longitude of the lagna (ascendant) at instant jd for given place"""
+  if state is None: state = sidereal_state(jd)
+  t0, gst, obliquity, ayanamsa = state
+  ramc = radians(gst + place.longitude + sidereal_rate * (jd - t0))
+  eps = radians(obliquity)
+  y = cos(ramc)
+  x = -(sin(ramc) * cos(eps) + tan(radians(place.latitude)) * sin(eps))
+  return (degrees(atan2(y, x)) - ayanamsa) % 360
+
+def lagna_day(jd, place, state, rise, next_rise):
+  """Lagna timetable from rise to next_rise (both julian days in UT)"""
+  lat, lon, tz = place
+  t0, gst, obliquity, ayanamsa = state
+  eps = radians(obliquity)
+  ramc_rise = gst + lon + sidereal_rate * (rise - t0)
+
+  # 1. Lagna at sunrise
+  first = ceil(ascendant(rise, place, state) / 30)
+  answer = [[int(first), to_dms((rise - jd) * 24 + tz)]]
+
+  # 2. Ascendant always moves forward, so each rashi begins exactly when its
+  # first point rises, i.e., when it reaches hour angle -H on the horizon
+  crossings = []
+  for k in range(12):
+    lam = radians(k * 30 + ayanamsa)   # Sayana longitude of the rashi's start
+    ra = degrees(atan2(sin(lam) * cos(eps), cos(lam)))
+    decl = asin(sin(lam) * sin(eps))
+    cos_h = -tan(radians(lat)) * tan(decl)
+    if abs(cos_h) > 1: continue   # Never rises at this latitude (rashi is skipped)
+    ramc = ra - degrees(acos(cos_h))
+    t = rise + ((ramc - ramc_rise) % 360) / sidereal_rate
+    while t < next_rise:
+      crossings.append([t, k + 1])
+      t += 360 / sidereal_rate
+
+  crossings.sort()
+  answer += [ [rashi, to_dms((t - jd) * 24 + tz)] for (t, rashi) in crossings ]
+  return answer
+
+def lagna_timetable(jds, places):
+  """Time at which each rashi rises between sunrise and next sunrise,
+     for every date jd in jds and every place in places.
+     Returns table[i][j] for places[i] on jds[j], each being a list of
+     [rashi, start time], beginning with the lagna at sunrise.
+  """
+  # Sidereal time, obliquity and ayanamsa are shared by all places
+  states = [sidereal_state(jd) for jd in jds]
+  table = []
+  for place in places:
+    tz = place.timezone
+    rises = {}  # Today's next sunrise is tomorrow's sunrise
+    row = []
+    for jd, state in zip(jds, states):
+      for day in [jd, jd + 1]:
+        if day not in rises: rises[day] = sunrise(day, place)[0] - tz / 24.
+      row.append(lagna_day(jd, place, state, rises[jd], rises[jd + 1]))
+    table.append(row)
+  return table
+
+Day = struct('Day', ['date', 'sunrise', 'sunset', 'vaara', 'tithi', 'nakshatra',
+                     'yoga', 'karana', 'masa', 'ritu', 'samvatsara'])
+
+def ending_times(jd, tz, rise, x, angles, parts, motion = None):
+  """Which of the 'parts' equal divisions of the circle the angle is in at
+     sunrise and when it ends (also the next one, if that is skipped), given
+     the angle sampled at rise + x, from x[0] = 0 up to next sunrise.
+     If motion is given (see refine), the end times are refined with it."""
+  span = 360 / parts
+  y = unwrap_angles(angles)
+  today = ceil(y[0] / span)
+  approx_end = inverse_lagrange(x, y, today * span)
+  if motion: approx_end = refine(motion, rise + approx_end, today * span) - rise
+  answer = [int(today), to_dms((rise + approx_end - jd) * 24 + tz)]
+  if y[-1] > (today + 1) * span:
+    approx_end = inverse_lagrange(x, y, (today + 1) * span)
+    if motion: approx_end = refine(motion, rise + approx_end, (today + 1) * span) - rise
+    answer += [int(today % parts + 1), to_dms((rise + approx_end - jd) * 24 + tz)]
+  return answer
+
+def iter_conventions(start_date, place, ayanamsas = [swe.SIDM_LAHIRI],
+                     months = ['amanta'], years = ['south'], precision = 'standard'):
+  """Like iter_days, but yields a dict of Day records for each combination
+     (ayanamsa, month system, year system) of the given swe.SIDM_* modes,
+     'amanta'/'purnimanta' months and 'south'/'north' samvatsaras.
+     All of them share the same sun and moon samples and new moons, so
+     only the ayanamsas are extra calls. Ritu and samvatsara follow the
+     amanta month in every combination. precision is as in tithi()."""
+  tz = place.timezone
+  jd = gregorian_to_jd(start_date)
+  rise = sunrise(jd, place)[0] - tz / 24
+  sun, moon = [solar_longitude(rise)], [lunar_longitude(rise)]
+  new_moons = []
+
+  while True:
+    # 1. Sample sun and moon at equal steps from sunrise to next sunrise
+    next_rise = sunrise(jd + 1, place)[0] - tz / 24
+    x = [ (next_rise - rise) * t for t in [0.0] + precision_offsets[precision] ]
+    exact = (precision == 'exact')
+    sun += [ solar_longitude(rise + t) for t in x[1:] ]
+    moon += [ lunar_longitude(rise + t) for t in x[1:] ]
+
+    # 2. Tithi and karana don't depend on ayanamsa
+    phases = [ (m - s) % 360 for (s, m) in zip(sun, moon) ]
+    ti = ending_times(jd, tz, rise, x, phases, 30, exact and tithi_motion)
+    kar = [int(ceil(phases[0] / 6))]
+
+    # 3. Month changes only after sunrise crosses the next new moon
+    if not new_moons:
+      last_new_moon = new_moon(rise, ti[0], -1, precision)
+      new_moons = [last_new_moon, solar_longitude(last_new_moon)]
+    if len(new_moons) == 2 or rise > new_moons[2]:
+      new_moons = new_moons[-2:]
+      next_new_moon = new_moon(rise, ti[0], +1, precision)
+      new_moons += [next_new_moon, solar_longitude(next_new_moon)]
+      solar_months = {}
+
+    date = Date(*jd_to_gregorian(jd)[:3])
+    srise, sset, vara = to_dms((rise - jd) * 24 + tz), sunset(jd, place)[1], vaara(jd)
+    days = {}
+    for mode in ayanamsas:
+      # 4. Nakshatra and yoga; ayanamsa is as good as constant within a day
+      ayanamsa = backend.ayanamsa(rise, mode)
+      nak = ending_times(jd, tz, rise, x, [ (m - ayanamsa) % 360 for m in moon ], 27,
+                         exact and (lambda t: nakshatra_motion(t, mode)))
+      yog = ending_times(jd, tz, rise, x, [ (s + m - 2 * ayanamsa) % 360
+                                            for (s, m) in zip(sun, moon) ], 27,
+                         exact and (lambda t: yoga_motion(t, mode)))
+
+      # 5. Solar months (raasi) at both new moons
+      if mode not in solar_months:
+        solar_months[mode] = [ int(ceil((new_moons[i+1] - backend.ayanamsa(new_moons[i], mode)) % 360 / 30))
+                               for i in [0, 2] ]
+      this_solar_month, next_solar_month = solar_months[mode]
+      maasa = this_solar_month % 12 + 1
+      amanta = [maasa, this_solar_month == next_solar_month]
+
+      for month_system in months:
+        mas = purnimanta(amanta, ti[0]) if month_system == 'purnimanta' else amanta
+        for year_system in years:
+          days[(mode, month_system, year_system)] = Day(date, srise, sset, vara, ti, nak,
+              yog, kar, mas, ritu(maasa), samvatsara(jd, maasa, year_system))
+    yield days
+
+    # 6. Slide the window: today's last samples are tomorrow's first
+    jd += 1
+    rise = next_rise
+    sun, moon = sun[-1:], moon[-1:]
+
+def iter_days(start_date, place, precision = 'standard'):
+  """Yields the panchanga (a Day record) for start_date and each day after it.
+     The samples at next sunrise become the next day's sunrise samples, and
+     the new moons bounding the month are only searched once per month."""
+  for days in iter_conventions(start_date, place, precision = precision):
+    yield list(days.values())[0]
+
 # ----- TESTS ------
 def all_tests():
   print(moonrise(date2, bangalore)) # Expected: 11:28:06
@@ -396,6 +801,123 @@ def masa_tests():
   print(masa(may20, helsinki))   # Vaisakha [2]
   print(masa(may21, helsinki))   # Jyestha [3]
 
+def navagraha_tests():
+  jan1 = gregorian_to_jd(Date(2013, 1, 1))
+  print(navagraha(date2, bangalore))  # Sun in Makara (274), Moon in Revati (353.5)
+  rise = sunrise(date2, bangalore)[0] - bangalore.timezone / 24.
+  hourly = nirayana_longitudes([rise + h / 24. for h in range(24)])
+  print(hourly[-1])
+  print(ingress(swe.SUN, jan1, jan1 + 31))          # Makara sankranti, 14 Jan 01:22 UT
+  print(ingress(swe.MOON, jan1, jan1 + 3, 27))      # Moon enters 3 nakshatras
+  mar1 = gregorian_to_jd(Date(2012, 3, 1))
+  print(ingress(swe.MERCURY, mar1, mar1 + 60))      # Retrograde into Kumbha (11) on 2 Apr, Meena (12) on 6 Apr
+
+def lagna_tests():
+  print(ascendant(date2, helsinki))  # Same as swe.houses() minus ayanamsa
+  table = lagna_timetable([date2, date2 + 1, date3], [bangalore, helsinki])
+  print(table[0][0])   # [10, [6,47,6]] Makara at sunrise, then [11, [8,26,58]], ...
+  print(table[1][0])   # [10, [9,6,31]], [11, [9,53,10]], ..., [10, [32,59,57]]
+  print(table[0][2])   # [2, [5,53,37]] Vrshabha at sunrise, then [3, [6,19,51]], ...
+
+def backend_tests():
+  import os, tempfile
+  filename = os.path.join(tempfile.gettempdir(), 'panchanga_calls.json')
+  workload = lambda: [tithi(date2, bangalore), nakshatra(date4, shillong),
+                      masa(date1, helsinki), navagraha(date3, bangalore)]
+  recorder = RecordingBackend()
+  old = set_backend(recorder)
+  expected = workload()
+  recorder.save(filename)
+  replay = ReplayBackend(filename)
+  set_backend(replay)
+  assert(workload() == expected)   # Same numbers without Swiss ephemeris
+  set_backend(old)
+  print(recorder.calls, len(replay.records))   # Total calls, distinct calls
+
+def iter_days_tests():
+  from itertools import islice
+  for day in islice(iter_days(Date(2012, 8, 16), bangalore), 4):
+    print(day)   # Shravana amavasya on 17 Aug, then Adhika Bhadrapada [6, True]
+  # Ephemeris calls for a month: rolling window vs. independent calls
+  start = gregorian_to_jd(Date(2013, 1, 1))
+  recorder = RecordingBackend()
+  old = set_backend(recorder)
+  days = list(islice(iter_days(Date(2013, 1, 1), helsinki), 30))
+  rolling = recorder.calls
+  for jd in [start + i for i in range(30)]:
+    [tithi(jd, helsinki), nakshatra(jd, helsinki), yoga(jd, helsinki),
+     karana(jd, helsinki), masa(jd, helsinki), sunset(jd, helsinki)]
+  set_backend(old)
+  print(rolling, recorder.calls - rolling)   # 442 vs. 3600
+
+def conventions_tests():
+  from itertools import islice
+  sep5 = gregorian_to_jd(Date(2012, 9, 5))
+  oct5 = gregorian_to_jd(Date(2012, 10, 5))
+  print(masa(sep5, bangalore, 'purnimanta'))   # Krishna paksha, Adhika Bhadrapada [6, True]
+  print(masa(oct5, bangalore, 'purnimanta'))   # Krishna paksha, Ashvina [7, False]
+  print(samvatsara(date2, 10, 'north'))        # 39 (Vishvavasu), 26 (Nandana) in south
+  ayanamsas = [swe.SIDM_LAHIRI, swe.SIDM_RAMAN, swe.SIDM_KRISHNAMURTI]
+  recorder = RecordingBackend()
+  old = set_backend(recorder)
+  one = list(islice(iter_conventions(Date(2012, 8, 1), bangalore), 60))
+  single = recorder.calls
+  many = list(islice(iter_conventions(Date(2012, 8, 1), bangalore, ayanamsas,
+                                      ['amanta', 'purnimanta'], ['south', 'north']), 60))
+  set_backend(old)
+  print(len(many[0]), single, recorder.calls - single)  # 12 conventions: 809 vs. 941 calls
+  print(many[35][(swe.SIDM_LAHIRI, 'purnimanta', 'north')])  # Sep 5, masa=[6, True], samvatsara=39
+
+def precision_report(years = range(1600, 2401, 25), places = None):
+  """Prints the largest end time error (in seconds) of each precision tier
+     against 'exact' and the ephemeris calls it needs per day, for three
+     dates a year in the given years at Bangalore, Shillong and Helsinki."""
+  from itertools import islice
+  places = places or [Place(12.972, 77.594, +5.5),   # Bangalore
+                       Place(25.569, 91.883, +5.5),   # Shillong
+                       Place(60.17, 24.935, +2.0)]    # Helsinki
+  dates = [ Date(year, month, 15) for year in years for month in [1, 5, 9] ]
+  seconds = lambda answer: [ from_dms(*hms) * 3600 for hms in answer[1::2] ]
+  tiers = ['exact', 'standard', 'fast']
+  results = {}
+  for precision in tiers:
+    recorder = RecordingBackend()
+    old = set_backend(recorder)
+    days, new_moons, calls = [], [], [0, 0, 0]
+    for place in places:
+      for date in dates:
+        jd = gregorian_to_jd(date)
+        start = recorder.calls
+        answers = [ f(jd, place, precision) for f in [tithi, nakshatra, yoga] ]
+        calls[0] += recorder.calls - start
+        start = recorder.calls
+        new_moons.append(new_moon(jd, answers[0][0], +1, precision) * 86400)
+        calls[1] += recorder.calls - start
+        start = recorder.calls
+        for day in islice(iter_days(date, place, precision), 7):
+          answers += [day.tithi, day.nakshatra, day.yoga]
+        calls[2] += recorder.calls - start
+        days.append(answers)
+    set_backend(old)
+    results[precision] = [days, new_moons, calls]
+
+  count = len(places) * len(dates)
+  print("%d dates from %d to %d at %d places" % (count, years[0], years[-1], len(places)))
+  print("tier       tithi+nakshatra+yoga   new moon          iter_days (7 days)")
+  print("           error   calls/day      error   calls      error   calls/day")
+  exact_days, exact_new_moons = results['exact'][:2]
+  for precision in tiers:
+    days, new_moons, calls = results[precision]
+    errors = [0, 0]
+    for (day, exact_day) in zip(days, exact_days):
+      for (i, (answer, exact)) in enumerate(zip(day, exact_day)):
+        numbers = answer[0::2] == exact[0::2]
+        error = max([ abs(a - b) for (a, b) in zip(seconds(answer), seconds(exact)) ])
+        errors[i >= 3] = max(errors[i >= 3], error if numbers else float('inf'))
+    new_moon_error = max([ abs(a - b) for (a, b) in zip(new_moons, exact_new_moons) ])
+    print("%-10s %5.0f %11.1f %10.1f %7.1f %10.0f %11.1f" % (precision, errors[0],
+          calls[0] / count, new_moon_error, calls[1] / count, errors[1], calls[2] / count / 7))
+
 if __name__ == "__main__":
   bangalore = Place(12.972, 77.594, +5.5)
   shillong = Place(25.569, 91.883, +5.5)
@@ -411,4 +933,10 @@ if __name__ == "__main__":
   # nakshatra_tests()
   # yoga_tests()
   masa_tests()
+  # navagraha_tests()
+  # lagna_tests()
+  # backend_tests()
+  # iter_days_tests()
+  # conventions_tests()
+  # precision_report()
   # new_moon(jd)